@@ -1,13 +1,17 @@
 import anthropic
+import httpx
 import os
 from dotenv import load_dotenv
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 import time
+import asyncio
 import logging
 
 load_dotenv()
 
-client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+# Connection pool shared by all Claude calls, requests are multiplexed over HTTP/2
+MAX_CONNECTIONS = 64
+MAX_KEEPALIVE_CONNECTIONS = 32
 
 logger = logging.getLogger(__name__)
 
@@ -19,7 +23,7 @@ class RateLimiter:
         self.request_tokens = []
         self.token_tokens = []
 
-    def wait_if_needed(self, tokens):
+    async def wait_if_needed(self, tokens):
         current_time = time.time()
 
         self.request_tokens = [
@@ -30,17 +34,37 @@ class RateLimiter:
         if len(self.request_tokens) >= self.rpm_limit or sum(self.token_tokens) + tokens > self.tpm_limit:
             sleep_time = 60 - \
                 (current_time - min(self.request_tokens + self.token_tokens))
-            logger.info(f"Rate limit reached. Sleeping for {sleep_time:.2f} seconds")
-            time.sleep(sleep_time)
+            logger.info("Rate limit reached. Sleeping for %.2f seconds", sleep_time)
+            await asyncio.sleep(sleep_time)
 
         self.request_tokens.append(current_time)
         self.token_tokens.append(tokens)
 
 
+def create_client() -> anthropic.AsyncAnthropic:
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=MAX_CONNECTIONS,
+                            max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS))
+    # Retries are handled by _create_message, keep the SDK from retrying on its own
+    return anthropic.AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"),
+                                    http_client=http_client, max_retries=0)
+
+
 # Adjust these values based on your tier and usage (https://docs.anthropic.com/en/api/rate-limits)
 rate_limiter = RateLimiter(rpm_limit=5, tpm_limit=20000)
 
 
+async def generate_response(client: anthropic.AsyncAnthropic, messages: list, system_message: str) -> str:
+    # Estimate token count (this is a rough estimate, you may want to use a proper tokenizer)
+    estimated_tokens = sum(len(m['content'].split())
+                           for m in messages) + len(system_message.split())
+
+    # Acquire the rate limit budget once, retries below reuse it
+    await rate_limiter.wait_if_needed(estimated_tokens)
+    return await _create_message(client, messages, system_message)
+
+
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=4, max=10),
@@ -48,15 +72,9 @@ rate_limiter = RateLimiter(rpm_limit=5, tpm_limit=20000)
         (anthropic.APIConnectionError, anthropic.APITimeoutError, anthropic.RateLimitError)),
     reraise=True
 )
-async def generate_response(messages: list, system_message: str) -> str:
+async def _create_message(client: anthropic.AsyncAnthropic, messages: list, system_message: str) -> str:
     try:
-        # Estimate token count (this is a rough estimate, you may want to use a proper tokenizer)
-        estimated_tokens = sum(len(m['content'].split())
-                               for m in messages) + len(system_message.split())
-
-        rate_limiter.wait_if_needed(estimated_tokens)
-
-        response = client.messages.create(
+        response = await client.messages.create(
             model="claude-3-5-sonnet-20240620",
             max_tokens=4096,
             system=system_message,
@@ -68,24 +86,24 @@ async def generate_response(messages: list, system_message: str) -> str:
         else:
             return "I apologize, but I couldn't formulate a response at this moment. Please try again."
     except anthropic.RateLimitError as e:
-        logger.error(f"Rate limit exceeded: {str(e)}")
+        logger.error("Rate limit exceeded: %s", e)
         retry_after = int(e.response.headers.get('retry-after', 60))
-        logger.info(f"Retrying after {retry_after} seconds")
-        time.sleep(retry_after)
+        logger.info("Retrying after %s seconds", retry_after)
+        await asyncio.sleep(retry_after)
         # Re-raise to trigger retry (https://docs.anthropic.com/en/api/errors)
         raise
     except anthropic.APIStatusError as e:
-        logger.error(f"API Status Error: {e.status_code} - {e.message}")
+        logger.error("API Status Error: %s - %s", e.status_code, e.message)
         if e.status_code in (500, 529):
             raise anthropic.APIError(f"Server error: {e.message}")
         else:
             raise  # Re-raise other status errors
     except (anthropic.APIConnectionError, anthropic.APITimeoutError) as e:
-        logger.error(f"Network error occurred: {str(e)}")
+        logger.error("Network error occurred: %s", e)
         raise
     except anthropic.APIError as e:
-        logger.error(f"API error occurred: {str(e)}")
+        logger.error("API error occurred: %s", e)
         raise
     except Exception as e:
-        logger.error(f"Unexpected error occurred: {str(e)}")
+        logger.error("Unexpected error occurred: %s", e)
         raise
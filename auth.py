@@ -1,11 +1,14 @@
 import os
-import json
+import io
 import shutil
 import datetime
+import functools
+import threading
+from collections import OrderedDict, deque
 import logging
-import aiofiles
+import asyncio
+import orjson
 from dotenv import load_dotenv
-import glob
 
 load_dotenv()
 
@@ -13,78 +16,288 @@ WHITELIST_FILE = "whitelist.txt"
 HISTORY_DIR = "user_histories"
 AUTH_CODE = os.getenv("AUTH_CODE")
 HISTORY_MESSAGES_COUNT = 1
+HISTORY_FLUSH_INTERVAL = 1  # Seconds the writer waits for more messages before flushing
+HISTORY_QUEUE_SIZE = 1000
+MAX_OPEN_HISTORY_FILES = 64
 
 logger = logging.getLogger(__name__)
 
 if not AUTH_CODE:
     raise ValueError("AUTH_CODE is not set in the environment variables. Please check your .env file.")
 
-def is_authenticated(user_id):
+def _load_whitelist():
     if not os.path.exists(WHITELIST_FILE):
-        return False
+        return set()
     with open(WHITELIST_FILE, "r") as f:
-        return str(user_id) in f.read().splitlines()
+        return set(f.read().splitlines())
+
+# Authenticated user ids, loaded once so lookups don't touch the disk on every update
+_WHITELIST: set[str] = _load_whitelist()
+
+def is_authenticated(user_id):
+    return str(user_id) in _WHITELIST
 
 def authenticate_user(user_id):
+    _WHITELIST.add(str(user_id))
     with open(WHITELIST_FILE, "a") as f:
         f.write(f"{user_id}\n")
 
-async def save_user_history(user_id, messages, scenario):
+# Most recent messages per (user_id, scenario), including ones not yet flushed to disk
+_HISTORY_CACHE: dict[tuple[str, str], list[dict]] = {}
+# Messages waiting to be appended to the history file, per conversation
+_PENDING_APPENDS: dict[tuple[str, str], list[dict]] = {}
+# Background task writing pending messages to disk
+_flush_task: asyncio.Task | None = None
+# Conversations that became dirty, consumed by the writer task
+_flush_queue: asyncio.Queue | None = None
+# Append handles of recently written history files, least recently used first
+_OPEN_HANDLES: OrderedDict[tuple[str, str], io.BufferedWriter] = OrderedDict()
+_HANDLES_LOCK = threading.Lock()
+# Held while a batch of pending messages is being written, so archives and history loads never race it
+_FLUSH_LOCK = asyncio.Lock()
+
+def _migrate_legacy_histories():
+    # Histories used to be rewritten as one JSON array per conversation, convert them to JSONL once
+    if not os.path.exists(HISTORY_DIR):
+        return
+    with os.scandir(HISTORY_DIR) as entries:
+        legacy_files = [entry.path for entry in entries if entry.name.endswith("_history.json")]
+    for legacy_file in legacy_files:
+        history_file = legacy_file + "l"
+        try:
+            with open(legacy_file, "rb") as f:
+                lines = b"".join(orjson.dumps(m) + b"\n" for m in orjson.loads(f.read()))
+            if os.path.exists(history_file):
+                # The legacy messages are older than anything already in JSONL
+                with open(history_file, "rb") as f:
+                    lines += f.read()
+            with open(history_file + ".tmp", "wb") as f:
+                f.write(lines)
+            os.replace(history_file + ".tmp", history_file)
+            os.remove(legacy_file)
+            logger.info("Migrated history file %s to %s", legacy_file, history_file)
+        except Exception as e:
+            logger.error("Error migrating history file %s: %s", legacy_file, e)
+
+def _load_known_users():
+    if not os.path.exists(HISTORY_DIR):
+        return set()
+    # A single directory listing at startup instead of a glob per lookup
+    with os.scandir(HISTORY_DIR) as entries:
+        return {
+            entry.name.split("_", 1)[0] for entry in entries
+            # Legacy files are only left behind when their migration failed
+            if entry.name.endswith(("_history.jsonl", "_history.json"))
+        }
+
+# Users that have at least one conversation history, filled by init_history_storage
+_KNOWN_USERS: set[str] = set()
+
+def init_history_storage():
+    # Called at startup once logging is configured, so migration results end up in the log
+    _migrate_legacy_histories()
+    _KNOWN_USERS.update(_load_known_users())
+
+def _history_key(user_id, scenario):
+    return (str(user_id), scenario)
+
+@functools.lru_cache(maxsize=1024)
+def _history_path(user_id, scenario):
+    return f"{HISTORY_DIR}/{user_id}_{scenario}_history.jsonl"
+
+def _legacy_history_path(user_id, scenario):
+    return f"{HISTORY_DIR}/{user_id}_{scenario}_history.json"
+
+@functools.lru_cache(maxsize=1024)
+def _scenario_path(user_id):
+    return f"{HISTORY_DIR}/{user_id}_scenario.txt"
+
+def _tail(messages):
+    # Use the global variable to determine how many messages to keep
+    msgs = HISTORY_MESSAGES_COUNT * 2
+    return list(messages)[-msgs:] if msgs > 0 else []
+
+def _get_append_handle(key):
+    # Must be called with _HANDLES_LOCK held
+    handle = _OPEN_HANDLES.get(key)
+    if handle is not None:
+        _OPEN_HANDLES.move_to_end(key)
+        return handle
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    handle = open(_history_path(*key), "ab")
+    _OPEN_HANDLES[key] = handle
+    if len(_OPEN_HANDLES) > MAX_OPEN_HISTORY_FILES:
+        _, oldest = _OPEN_HANDLES.popitem(last=False)
+        oldest.close()
+    return handle
+
+def _close_append_handle(key):
+    # Must be called with _HANDLES_LOCK held
+    handle = _OPEN_HANDLES.pop(key, None)
+    if handle is not None:
+        handle.close()
+
+def _append_history_sync(key, messages):
+    with _HANDLES_LOCK:
+        handle = _get_append_handle(key)
+        handle.write(b"".join(orjson.dumps(m) + b"\n" for m in messages))
+        handle.flush()
+
+def close_history_files():
+    with _HANDLES_LOCK:
+        while _OPEN_HANDLES:
+            _, handle = _OPEN_HANDLES.popitem()
+            handle.close()
+
+def _flush_histories_sync(pending):
+    for key, messages in pending.items():
+        user_id, scenario = key
+        try:
+            _append_history_sync(key, messages)
+            logger.info("Successfully saved history for user %s in scenario %s", user_id, scenario)
+        except Exception as e:
+            logger.error("Error saving history for user %s in scenario %s: %s", user_id, scenario, e)
+
+async def flush_user_histories():
+    async with _FLUSH_LOCK:
+        if not _PENDING_APPENDS:
+            return
+        pending = dict(_PENDING_APPENDS)
+        _PENDING_APPENDS.clear()
+        # A single thread dispatch for all open + write calls is cheaper than aiofiles' per-operation hops
+        await asyncio.to_thread(_flush_histories_sync, pending)
+
+async def _flush_loop():
+    # Sleeps until a conversation has pending messages instead of polling
+    while True:
+        await _flush_queue.get()
+        await asyncio.sleep(HISTORY_FLUSH_INTERVAL)
+        while not _flush_queue.empty():
+            _flush_queue.get_nowait()
+        await flush_user_histories()
+
+def _notify_flusher(key):
+    if _flush_queue is None:
+        return  # Not started yet; stop_history_flusher still writes everything pending
+    try:
+        _flush_queue.put_nowait(key)
+    except asyncio.QueueFull:
+        pass  # The writer is already due and flushes every pending conversation
+
+def start_history_flusher():
+    global _flush_task, _flush_queue
+    if _flush_task is None:
+        _flush_queue = asyncio.Queue(maxsize=HISTORY_QUEUE_SIZE)
+        _flush_task = asyncio.create_task(_flush_loop())
+
+async def stop_history_flusher():
+    global _flush_task, _flush_queue
+    if _flush_task is not None:
+        _flush_task.cancel()
+        try:
+            await _flush_task
+        except asyncio.CancelledError:
+            pass
+        _flush_task = None
+        _flush_queue = None
+    await flush_user_histories()
+    close_history_files()
+
+def save_user_history(user_id, new_messages, scenario):
+    """Record messages added to a conversation; the background flusher appends them to its JSONL file."""
+    key = _history_key(user_id, scenario)
+    _KNOWN_USERS.add(str(user_id))
+    cached = _HISTORY_CACHE.get(key)
+    if cached is not None:
+        cached.extend(new_messages)
+        _HISTORY_CACHE[key] = _tail(cached)
+    pending = _PENDING_APPENDS.get(key)
+    if pending is None:
+        _PENDING_APPENDS[key] = list(new_messages)
+        _notify_flusher(key)
+    else:
+        pending.extend(new_messages)
+
+def _read_history_tail(history_file):
     try:
-        if not os.path.exists(HISTORY_DIR):
-            os.makedirs(HISTORY_DIR)
-        async with aiofiles.open(f"{HISTORY_DIR}/{user_id}_{scenario}_history.json", "w") as f:
-            await f.write(json.dumps(messages, indent=2))
-        logger.info(f"Successfully saved history for user {user_id} in scenario {scenario}")
-    except Exception as e:
-        logger.error(f"Error saving history for user {user_id} in scenario {scenario}: {str(e)}")
-
-def load_user_history(user_id, scenario):
-    history_file = f"{HISTORY_DIR}/{user_id}_{scenario}_history.json"
-    if not os.path.exists(history_file):
+        with open(history_file, "rb") as f:
+            # Only the last lines are parsed, however long the conversation is
+            lines = deque(f, maxlen=HISTORY_MESSAGES_COUNT * 2)
+    except FileNotFoundError:
         return []
-    with open(history_file, "r") as f:
-        full_history = json.load(f)
-        # Use the global variable to determine how many messages to return
-        msgs = HISTORY_MESSAGES_COUNT * 2
-        return full_history[-msgs:] if len(full_history) >= msgs else full_history
+    return [orjson.loads(line) for line in lines]
+
+async def load_user_history(user_id, scenario):
+    key = _history_key(user_id, scenario)
+    history = _HISTORY_CACHE.get(key)
+    if history is None:
+        # A batch being written is neither pending nor surely on disk, so wait for it
+        async with _FLUSH_LOCK:
+            history = await asyncio.to_thread(_read_history_tail, _history_path(*key))
+        # The cache is only touched here, on the event loop thread
+        history = _tail(history + _PENDING_APPENDS.get(key, []))
+        _HISTORY_CACHE[key] = history
+    return list(history)
 
 # Add this new function to set the history messages count
 def set_history_messages_count(count):
     global HISTORY_MESSAGES_COUNT
+    if count > HISTORY_MESSAGES_COUNT:
+        # Cached tails are too short now, reload them from disk on next access
+        _HISTORY_CACHE.clear()
     HISTORY_MESSAGES_COUNT = count
 
 def get_history_messages_count():
     return HISTORY_MESSAGES_COUNT
 
 def save_user_scenario(user_id, scenario):
-    if not os.path.exists(HISTORY_DIR):
-        os.makedirs(HISTORY_DIR)
-    with open(f"{HISTORY_DIR}/{user_id}_scenario.txt", "w") as f:
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    with open(_scenario_path(str(user_id)), "w") as f:
         f.write(scenario)
 
 def load_user_scenario(user_id):
-    scenario_file = f"{HISTORY_DIR}/{user_id}_scenario.txt"
-    if not os.path.exists(scenario_file):
+    try:
+        with open(_scenario_path(str(user_id)), "r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
         return 'boyfriend'  # Default scenario
-    with open(scenario_file, "r") as f:
-        return f.read().strip()
 
-def clear_user_history(user_id, scenario):
-    archive_user_history(user_id, scenario)
-    with open(f"{HISTORY_DIR}/{user_id}_{scenario}_history.json", "w") as f:
-        json.dump([], f)
+def _forget_history(key):
+    # Must be called on the event loop thread, which owns the cache and pending appends
+    _HISTORY_CACHE.pop(key, None)
+    return _PENDING_APPENDS.pop(key, None)
+
+def _archive_history_file(key, timestamp):
+    os.makedirs("archive", exist_ok=True)
+    user_id, scenario = key
+    history_file = _history_path(*key)
+    # Held across the move so the flusher can't reopen the file before it is gone
+    with _HANDLES_LOCK:
+        _close_append_handle(key)
+        if os.path.exists(history_file):
+            archive_file = f"archive/{user_id}_{scenario}_history_{timestamp}.jsonl"
+            shutil.move(history_file, archive_file)
+    legacy_file = _legacy_history_path(*key)
+    if os.path.exists(legacy_file):
+        shutil.move(legacy_file, f"archive/{user_id}_{scenario}_history_{timestamp}.json")
 
-def archive_user_history(user_id, scenario):
-    if not os.path.exists("archive"):
-        os.makedirs("archive")
+def _archive_history_files(pending, timestamp):
+    for key, messages in pending.items():
+        if messages:
+            # Messages not flushed yet belong to the conversation being archived
+            _append_history_sync(key, messages)
+        _archive_history_file(key, timestamp)
 
-    history_file = f"{HISTORY_DIR}/{user_id}_{scenario}_history.json"
-    if os.path.exists(history_file):
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        archive_file = f"archive/{user_id}_{scenario}_history_{timestamp}.json"
-        shutil.move(history_file, archive_file)
+async def archive_user_histories(user_id, scenarios):
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    # No flush can be writing these conversations while their files are moved
+    async with _FLUSH_LOCK:
+        pending = {}
+        for scenario in scenarios:
+            key = _history_key(user_id, scenario)
+            pending[key] = _forget_history(key)
+        # Moves are renames serialized by the handles lock, so one worker thread does them all
+        await asyncio.to_thread(_archive_history_files, pending, timestamp)
 
 def is_new_user(user_id):
-    user_history_files = glob.glob(f"{HISTORY_DIR}/{user_id}_*_history.json")
-    return len(user_history_files) == 0
+    return str(user_id) not in _KNOWN_USERS
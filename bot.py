@@ -1,113 +1,274 @@
 import logging
 import asyncio
-import time
+from time import perf_counter
+import functools
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from collections import deque
+from types import MappingProxyType
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
 from telegram.constants import ChatAction
-from telegram.error import NetworkError, TimedOut
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, TimedOut
 from dotenv import load_dotenv
 import os
-from anthropic_api import generate_response
-from utils import format_message, truncate_message, split_long_message, sanitize_input
+from anthropic_api import create_client, generate_response
+from utils import format_message, has_markdown_chars, unescape_markdown, truncate_message, split_long_message, sanitize_input
 from auth import (
     is_authenticated, authenticate_user, save_user_history, load_user_history, AUTH_CODE, save_user_scenario, load_user_scenario,
-    archive_user_history, is_new_user, set_history_messages_count, get_history_messages_count
+    archive_user_histories, is_new_user, set_history_messages_count, get_history_messages_count,
+    init_history_storage, start_history_flusher, stop_history_flusher
 )
 from scenarios import SCENARIOS
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+
+try:
+    import uvloop
+except ImportError:  # Not available on Windows
+    uvloop = None
 
 load_dotenv()
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    filename='bot.log'
-)
+# Records are still rendered on the calling thread (QueueHandler.prepare); only the file formatting and write run in the listener thread
+log_queue = queue.SimpleQueue()
+log_file_handler = logging.FileHandler('bot.log')
+log_file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_listener = QueueListener(log_queue, log_file_handler)
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
 logger = logging.getLogger(__name__)
 
 API_TIMEOUT = 30
+SEND_ATTEMPTS = 3
+WEBHOOK_PATH = "telegram"
+TYPING_DELAY = 2.0  # Responses faster than this are sent without a typing action
+TYPING_INTERVAL = 4.5  # A typing action stays visible for about 5 seconds
 
 class RateLimiter:
     def __init__(self, max_calls, period):
         self.max_calls = max_calls
         self.period = period
-        self.calls = []
+        self.calls = deque()
+        self._lock = asyncio.Lock()
 
     async def wait(self):
-        now = time.time()
-        self.calls = [call for call in self.calls if call > now - self.period]
-        if len(self.calls) >= self.max_calls:
-            sleep_time = self.period - (now - self.calls[0])
-            logger.info(f"Rate limit reached. Sleeping for {sleep_time:.2f} seconds")
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            while self.calls and self.calls[0] <= now - self.period:
+                self.calls.popleft()
+            # Reserve a slot before sleeping so concurrent callers see it and queue up behind it
+            slot = now
+            if len(self.calls) >= self.max_calls:
+                slot = max(now, self.calls[-self.max_calls] + self.period)
+            self.calls.append(slot)
+        sleep_time = slot - now
+        if sleep_time > 0:
+            logger.info("Rate limit reached. Sleeping for %.2f seconds", sleep_time)
             await asyncio.sleep(sleep_time)
-        self.calls.append(now)
 
-rate_limiter = RateLimiter(max_calls=5, period=60)  # 5 calls per minute
+class PerKeyRateLimiter:
+    def __init__(self, max_calls, period):
+        self.max_calls = max_calls
+        self.period = period
+        self.limiters = {}
+        self.next_eviction = 0.0
+
+    async def wait(self, key):
+        now = asyncio.get_running_loop().time()
+        if now >= self.next_eviction:
+            # Limiters with no call left in their window hold no state worth keeping
+            self.limiters = {
+                k: limiter for k, limiter in self.limiters.items()
+                if limiter.calls and limiter.calls[-1] > now - self.period
+            }
+            self.next_eviction = now + self.period
+        limiter = self.limiters.get(key)
+        if limiter is None:
+            limiter = self.limiters[key] = RateLimiter(self.max_calls, self.period)
+        await limiter.wait()
+
+# 5 Claude calls per minute for each user; the account-wide quota is enforced in anthropic_api
+user_rate_limiter = PerKeyRateLimiter(max_calls=5, period=60)
+
+class PerChatRateLimiter:
+    def __init__(self, interval, max_chats=1000):
+        self.interval = interval
+        self.max_chats = max_chats
+        self.next_send = {}
+
+    def reserve(self, chat_id):
+        # Returns how long to wait before sending; slots are handed out in call order
+        now = asyncio.get_running_loop().time()
+        if len(self.next_send) > self.max_chats:
+            self.next_send = {chat: t for chat, t in self.next_send.items() if t > now}
+        send_at = max(now, self.next_send.get(chat_id, now))
+        self.next_send[chat_id] = send_at + self.interval
+        return send_at - now
+
+# Telegram flood limits: about 1 message per second per chat and 30 per second overall
+chat_send_limiter = PerChatRateLimiter(interval=1.0)
+global_send_limiter = RateLimiter(max_calls=30, period=1)
+
+COMMON_ACTIONS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Change Scenario", callback_data='change_scenario'),
+     InlineKeyboardButton("Clear History", callback_data='clear_history')],
+    [InlineKeyboardButton("Help", callback_data='help')]
+])
+
+SCENARIO_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Demon Slayer", callback_data='demon_slayer'),
+     InlineKeyboardButton("Boyfriend", callback_data='boyfriend')],
+    [InlineKeyboardButton("Best Friend", callback_data='best_friend'),
+     InlineKeyboardButton("Mentor", callback_data='mentor')],
+    [InlineKeyboardButton("Sibling", callback_data='sibling'),
+     InlineKeyboardButton("Coach", callback_data='coach')],
+    [InlineKeyboardButton("Guidance Counselor", callback_data='guidance_counselor'),
+     InlineKeyboardButton("Cpp Expert", callback_data='cpp_expert')],
+    [InlineKeyboardButton("Socratic Tutor", callback_data='socratic_tutor'),
+     InlineKeyboardButton("Mental Health Advocate", callback_data='mental_health_advocate')]])
+
+SCENARIO_PROMPT = (
+    "Choose who you'd like to talk to:\n\n"
+    "🗡️ Demon Slayer: Chat with a brave warrior from Taisho-era Japan\n"
+    "💑 Boyfriend: Talk to your caring high school boyfriend\n"
+    "🤝 Best Friend: Hang out with your supportive and fun-loving best friend, Tiffany\n"
+    "📚 Mentor: Seek wisdom from your high school teacher\n"
+    "👶 Sibling: Play with your 6-year-old younger brother\n"
+    "🏋️ Coach: Get motivated by your dedicated high school sports coach\n"
+    "🧠 Guidance Counselor: Discuss your concerns with the school counselor\n"
+    "🧠 cpp Expert: Learn about C++ programming language\n\n"
+    "🎓 Socratic Tutor: Learn through guided questioning\n\n"
+    "💚 Mental Health Advocate: Talk to a compassionate mental health professional\n\n"
+    "Select an option to change who you're talking to:"
+)
+
+SCENARIO_DESCRIPTIONS = MappingProxyType({
+    'demon_slayer': "Demon Slayer - You're now chatting with a brave warrior from early 20th century Japan!",
+    'boyfriend': "Boyfriend - You're now talking to your caring high school boyfriend!",
+    'best_friend': "Best Friend - You're now hanging out with your supportive and fun-loving best friend, Tiffany!",
+    'mentor': "Mentor - You're now seeking wisdom from your high school teacher!",
+    'sibling': "Sibling - You're now playing with your 6-year-old younger brother!",
+    'coach': "Coach - You're now getting motivated by your dedicated high school sports coach!",
+    'guidance_counselor': "Guidance Counselor - You're now discussing your concerns with the school counselor!",
+    'cpp_expert': "C++ Expert - You're now talking to a skilled C++ developer!",
+    'socratic_tutor': "Socratic Tutor - You're now learning through guided questioning!",
+    'mental_health_advocate': "Mental Health Advocate - You're now talking to a compassionate mental health professional!",
+})
+
+UNAUTHENTICATED_MESSAGE = "I'm sorry, %s, but I can only assist authenticated users. Please provide the secret code first."
 
 def get_user_name(user):
     if user.last_name:
         return f"{user.first_name} {user.last_name}"
     return user.first_name
 
-def get_common_actions_keyboard():
-    keyboard = [
-        [InlineKeyboardButton("Change Scenario", callback_data='change_scenario'),
-         InlineKeyboardButton("Clear History", callback_data='clear_history')],
-        [InlineKeyboardButton("Help", callback_data='help')]
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=4, max=10),
-    retry=retry_if_exception_type((NetworkError, TimedOut)),
-    reraise=True
-)
-async def send_message_with_retry(context, chat_id, text, reply_markup=None):
-    try:
-        formatted_text = format_message(text)
-        if len(formatted_text) > 4096:
-            parts = split_long_message(formatted_text)
-            for part in parts:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=part,
-                    parse_mode='MarkdownV2',
-                    reply_markup=reply_markup
-                )
-        else:
-            await context.bot.send_message(
+async def send_with_backoff(context, chat_id, text, parse_mode=None, reply_markup=None):
+    # Up to SEND_ATTEMPTS tries; network errors wait 4s then 8s (capped at 10s), flood control waits retry_after
+    for attempt in range(SEND_ATTEMPTS):
+        try:
+            return await context.bot.send_message(
                 chat_id=chat_id,
-                text=formatted_text,
-                parse_mode='MarkdownV2',
+                text=text,
+                parse_mode=parse_mode,
                 reply_markup=reply_markup
             )
-    except Exception as e:
-        logger.error(f"Error sending message: {str(e)}")
-        truncated_text = truncate_message(text)
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=truncated_text,
-            reply_markup=reply_markup
-        )
+        except RetryAfter as e:
+            if attempt == SEND_ATTEMPTS - 1:
+                raise
+            # Flood control tells us exactly how long to back off
+            await asyncio.sleep(e.retry_after)
+        except BadRequest:
+            # A subclass of NetworkError, but resending the same request fails the same way
+            raise
+        except (NetworkError, TimedOut):
+            if attempt == SEND_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(min(10, 4 * 2 ** attempt))
+
+async def send_part_at(context, chat_id, text, delay, parse_mode=None, reply_markup=None):
+    if delay > 0:
+        await asyncio.sleep(delay)
+    await global_send_limiter.wait()
+    await send_with_backoff(context, chat_id, text, parse_mode, reply_markup)
+
+async def send_message_with_retry(context, chat_id, text, reply_markup=None, parse_mode=None):
+    # Fixed UI texts go out as plain text; only Claude responses ask for MarkdownV2
+    if parse_mode == 'MarkdownV2' and has_markdown_chars(text):
+        formatted_text = format_message(text)
+    else:
+        # Nothing to convert or escape, so the text goes out as is
+        formatted_text, parse_mode = text, None
+    parts = split_long_message(formatted_text) if len(formatted_text) > 4096 else (formatted_text,)
+    delivered = 0
+    try:
+        # Each part waits for the previous one, so retries can't reorder them; chat_send_limiter paces them
+        for part in parts:
+            await send_part_at(context, chat_id, part, chat_send_limiter.reserve(chat_id), parse_mode, reply_markup)
+            delivered += 1
+    except BadRequest as e:
+        # Only a Markdown parse failure is worth resending as plain text
+        if "can't parse entities" not in str(e).lower():
+            raise
+        logger.error("Error sending message: %s", e)
+        if delivered == 0:
+            # Nothing was delivered, so fall back to the original text
+            unsent = [truncate_message(text)]
+        else:
+            unsent = [unescape_markdown(part) for part in parts[delivered:]]
+        for part in unsent:
+            await send_part_at(context, chat_id, part, chat_send_limiter.reserve(chat_id), reply_markup=reply_markup)
 
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=4, max=10),
-    retry=retry_if_exception_type((NetworkError, TimedOut)),
-    reraise=True
-)
-async def rate_limited_generate_response(messages, system_message):
-    await rate_limiter.wait()
-    return await generate_response(messages, system_message)
+async def rate_limited_generate_response(context, user_id, messages, system_message):
+    await user_rate_limiter.wait(user_id)
+    return await generate_response(context.bot_data['anthropic'], messages, system_message)
 
+async def generate_response_with_typing(context, chat_id, user_id, messages, system_message):
+    response_task = asyncio.create_task(rate_limited_generate_response(context, user_id, messages, system_message))
+    timeout = TYPING_DELAY
+    try:
+        while True:
+            try:
+                # Fast responses return here without any typing action
+                return await asyncio.wait_for(asyncio.shield(response_task), timeout=timeout)
+            except asyncio.TimeoutError:
+                try:
+                    await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+                except TelegramError as e:
+                    # The indicator is cosmetic; keep waiting for the response already in flight
+                    logger.warning("Error sending typing action to chat %s: %s", chat_id, e)
+                timeout = TYPING_INTERVAL
+    finally:
+        response_task.cancel()
+
+async def send_unauthenticated_message(context, chat_id, user_name):
+    await send_message_with_retry(context, chat_id, UNAUTHENTICATED_MESSAGE % user_name)
+
+def require_auth(handler):
+    # Answers unauthenticated users before the handler runs
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        if not is_authenticated(update.effective_user.id):
+            await send_unauthenticated_message(context, update.effective_chat.id, get_user_name(update.effective_user))
+            return
+        return await handler(update, context, *args, **kwargs)
+    return wrapper
+
+def one_at_a_time_per_user(handler):
+    # Updates run concurrently; a user's own updates still take turns on their conversation in user_data
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        async with context.user_data.setdefault('lock', asyncio.Lock()):
+            return await handler(update, context, *args, **kwargs)
+    return wrapper
+
+@one_at_a_time_per_user
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user_name = get_user_name(update.effective_user)
     if is_authenticated(user_id):
-        scenario = load_user_scenario(user_id)
-        context.user_data['scenario'] = scenario
-        context.user_data['messages'] = load_user_history(user_id, scenario)
+        scenario = context.user_data.get('scenario')
+        if scenario is None or 'messages' not in context.user_data:
+            scenario = await asyncio.to_thread(load_user_scenario, user_id)
+            context.user_data['scenario'] = scenario
+            context.user_data['messages'] = await load_user_history(user_id, scenario)
 
         message = (
             f"Welcome back, {user_name}! 🎭\n\n"
@@ -116,17 +277,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Now, what would you like to chat about with your {scenario}? 😃"
         )
 
-        await send_message_with_retry(context, update.effective_chat.id, message, reply_markup=get_common_actions_keyboard())
+        await send_message_with_retry(context, update.effective_chat.id, message, reply_markup=COMMON_ACTIONS_KEYBOARD)
     else:
         await send_message_with_retry(context, update.effective_chat.id, f"Greetings, {user_name}! 🌟 To start chatting with Evander please provide the secret code. What's the password?")
 
+@require_auth
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    user_name = get_user_name(update.effective_user)
-    if not is_authenticated(user_id):
-        await send_message_with_retry(context, update.effective_chat.id, f"I'm sorry, {user_name}, but I can only assist authenticated users. Please provide the secret code first.")
-        return
-
     help_text = """
     Here are the available actions:
     • /change_scenario - Switch to a different character to talk to
@@ -142,61 +298,31 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     You can also send me any message, and I'll respond based on the current scenario!
     """
-    await send_message_with_retry(context, update.effective_chat.id, help_text, reply_markup=get_common_actions_keyboard())
+    await send_message_with_retry(context, update.effective_chat.id, help_text, reply_markup=COMMON_ACTIONS_KEYBOARD)
 
 
 
+@require_auth
+@one_at_a_time_per_user
 async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user_name = get_user_name(update.effective_user)
-    if not is_authenticated(user_id):
-        await send_message_with_retry(context, update.effective_chat.id, f"I'm sorry, {user_name}, but I can only assist authenticated users. Please provide the secret code first.")
-        return
 
-    for scenario in SCENARIOS.keys():
-        archive_user_history(user_id, scenario)
+    await archive_user_histories(user_id, SCENARIOS)
 
     context.user_data['messages'] = []
-    context.user_data['scenario'] = load_user_scenario(user_id)
+    context.user_data['scenario'] = await asyncio.to_thread(load_user_scenario, user_id)
 
-    await send_message_with_retry(context, update.effective_chat.id, "All your conversation histories across all scenarios have been reset. you are currently chatting with your '{}'.".format(context.user_data['scenario']), reply_markup=get_common_actions_keyboard())
+    await send_message_with_retry(context, update.effective_chat.id, "All your conversation histories across all scenarios have been reset. you are currently chatting with your '{}'.".format(context.user_data['scenario']), reply_markup=COMMON_ACTIONS_KEYBOARD)
 
+@require_auth
 async def change_scenario(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    user_name = get_user_name(update.effective_user)
-    if not is_authenticated(user_id):
-        await send_message_with_retry(context, update.effective_chat.id, f"I'm sorry, {user_name}, but I can only assist authenticated users. Please provide the secret code first.")
-        return
-
-    keyboard = [
-        [InlineKeyboardButton("Demon Slayer", callback_data='demon_slayer'),
-         InlineKeyboardButton("Boyfriend", callback_data='boyfriend')],
-        [InlineKeyboardButton("Best Friend", callback_data='best_friend'),
-         InlineKeyboardButton("Mentor", callback_data='mentor')],
-        [InlineKeyboardButton("Sibling", callback_data='sibling'),
-         InlineKeyboardButton("Coach", callback_data='coach')],
-        [InlineKeyboardButton("Guidance Counselor", callback_data='guidance_counselor'),
-         InlineKeyboardButton("Cpp Expert", callback_data='cpp_expert')],
-        [InlineKeyboardButton("Socratic Tutor", callback_data='socratic_tutor'),
-        InlineKeyboardButton("Mental Health Advocate", callback_data='mental_health_advocate')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text="Choose who you'd like to talk to:\n\n"
-             "🗡️ Demon Slayer: Chat with a brave warrior from Taisho-era Japan\n"
-             "💑 Boyfriend: Talk to your caring high school boyfriend\n"
-             "🤝 Best Friend: Hang out with your supportive and fun-loving best friend, Tiffany\n"
-             "📚 Mentor: Seek wisdom from your high school teacher\n"
-             "👶 Sibling: Play with your 6-year-old younger brother\n"
-             "🏋️ Coach: Get motivated by your dedicated high school sports coach\n"
-             "🧠 Guidance Counselor: Discuss your concerns with the school counselor\n"
-             "🧠 cpp Expert: Learn about C++ programming language\n\n"
-             "🎓 Socratic Tutor: Learn through guided questioning\n\n"
-             "💚 Mental Health Advocate: Talk to a compassionate mental health professional\n\n"
-             "Select an option to change who you're talking to:",
-        reply_markup=reply_markup
+        text=SCENARIO_PROMPT,
+        reply_markup=SCENARIO_KEYBOARD
     )
 
+@one_at_a_time_per_user
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -212,43 +338,33 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
         new_scenario = query.data
         old_scenario = context.user_data.get('scenario', 'boyfriend')
-        context.user_data['scenario'] = new_scenario
-        context.user_data['messages'] = load_user_history(user_id, new_scenario)
-        save_user_scenario(user_id, new_scenario)
-
-        scenario_descriptions = {
-            'demon_slayer': "Demon Slayer - You're now chatting with a brave warrior from early 20th century Japan!",
-            'boyfriend': "Boyfriend - You're now talking to your caring high school boyfriend!",
-            'best_friend': "Best Friend - You're now hanging out with your supportive and fun-loving best friend, Tiffany!",
-            'mentor': "Mentor - You're now seeking wisdom from your high school teacher!",
-            'sibling': "Sibling - You're now playing with your 6-year-old younger brother!",
-            'coach': "Coach - You're now getting motivated by your dedicated high school sports coach!",
-            'guidance_counselor': "Guidance Counselor - You're now discussing your concerns with the school counselor!",
-            'cpp_expert': "C++ Expert - You're now talking to a skilled C++ developer!",
-            'socratic_tutor': "Socratic Tutor - You're now learning through guided questioning!",
-            'mental_health_advocate': "Mental Health Advocate - You're now talking to a compassionate mental health professional!",
-        }
+        # Re-selecting the current scenario keeps the conversation already held in user_data
+        if new_scenario != context.user_data.get('scenario') or 'messages' not in context.user_data:
+            context.user_data['scenario'] = new_scenario
+            context.user_data['messages'] = await load_user_history(user_id, new_scenario)
+            await asyncio.to_thread(save_user_scenario, user_id, new_scenario)
 
         await query.edit_message_text(
-            text=f"You've switched from talking to your {old_scenario} to your {scenario_descriptions[new_scenario]}\n\n"
+            text=f"You've switched from talking to your {old_scenario} to your {SCENARIO_DESCRIPTIONS[new_scenario]}\n\n"
             f"Your conversation history has been updated to match. Enjoy chatting!",
-            reply_markup=get_common_actions_keyboard()
+            reply_markup=COMMON_ACTIONS_KEYBOARD
         )
 
+@one_at_a_time_per_user
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user_name = get_user_name(update.effective_user)
     user_message = sanitize_input(update.message.text)
     chat_id = update.effective_chat.id
 
-    logger.info(f"Received message from user {user_id} ({user_name}): {user_message[:20]}...")
+    logger.info("Received message from user %s (%s): %.20s...", user_id, user_name, user_message)
 
     if not is_authenticated(user_id):
         if user_message == AUTH_CODE:
-            authenticate_user(user_id)
-            scenario = load_user_scenario(user_id)
+            await asyncio.to_thread(authenticate_user, user_id)
+            scenario = await asyncio.to_thread(load_user_scenario, user_id)
             context.user_data['scenario'] = scenario
-            context.user_data['messages'] = load_user_history(user_id, scenario)
+            context.user_data['messages'] = await load_user_history(user_id, scenario)
 
             if is_new_user(user_id):
                 welcome_message = (
@@ -259,48 +375,59 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     f"Feel free to ask me anything or just chat casually!\n\n"
                     f"Enjoy your time with Mark Llego's AI companion! 😊"
                 )
-                await send_message_with_retry(context, chat_id, welcome_message, reply_markup=get_common_actions_keyboard())
+                await send_message_with_retry(context, chat_id, welcome_message, reply_markup=COMMON_ACTIONS_KEYBOARD)
             else:
                 message = (
                     f"Welcome back, {user_name}! You're now authenticated. "
                     f"Your current scenario is {scenario}. "
                     f"You can start chatting now."
                 )
-                await send_message_with_retry(context, chat_id, message, reply_markup=get_common_actions_keyboard())
+                await send_message_with_retry(context, chat_id, message, reply_markup=COMMON_ACTIONS_KEYBOARD)
         else:
-            await send_message_with_retry(context, chat_id, f"I'm sorry, {user_name}, but I can only assist authenticated users. Please provide the secret code.")
+            await send_unauthenticated_message(context, chat_id, user_name)
         return
 
+    history_count = get_history_messages_count()
     if 'messages' not in context.user_data:
-        scenario = load_user_scenario(user_id)
+        scenario = await asyncio.to_thread(load_user_scenario, user_id)
         context.user_data['scenario'] = scenario
-        context.user_data['messages'] = load_user_history(user_id, scenario)
+        context.user_data['messages'] = await load_user_history(user_id, scenario)
+    elif history_count > context.user_data.get('history_count', history_count):
+        # The window grew since this conversation was last trimmed, so reload it
+        context.user_data['messages'] = await load_user_history(user_id, context.user_data['scenario'])
+    context.user_data['history_count'] = history_count
 
-    context.user_data['messages'].append({"role": "user", "content": user_message})
+    user_entry = {"role": "user", "content": user_message}
+    messages = context.user_data['messages']
+    messages.append(user_entry)
 
     try:
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-
         scenario = context.user_data['scenario']
         system_message = SCENARIOS[scenario]
+        # Only the configured number of previous exchanges goes to Claude along with the new message
+        messages_to_send = messages[-(history_count * 2 + 1):]
 
-        start_time = time.time()
-        response = await rate_limited_generate_response(context.user_data['messages'], system_message)
-        end_time = time.time()
+        start_time = perf_counter()
+        response = await generate_response_with_typing(context, chat_id, user_id, messages_to_send, system_message)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("API response time: %.2f seconds", perf_counter() - start_time)
 
-        response_time = end_time - start_time
-        logger.info(f"API response time: {response_time:.2f} seconds")
+        assistant_entry = {"role": "assistant", "content": response}
+        messages.append(assistant_entry)
+        # The full history is on disk; keep in memory only what the next request can use
+        del messages[:max(len(messages) - history_count * 2, 0)]
 
-        context.user_data['messages'].append({"role": "assistant", "content": response})
+        save_user_history(user_id, [user_entry, assistant_entry], scenario)
 
-        asyncio.create_task(save_user_history(user_id, context.user_data['messages'], scenario))
+        await send_message_with_retry(context, chat_id, response, parse_mode='MarkdownV2')
 
-        await send_message_with_retry(context, chat_id, response)
-
-        logger.info(f"Sent response to user {user_id} ({user_name}): {response[:20]}...")
+        logger.info("Sent response to user %s (%s): %.20s...", user_id, user_name, response)
 
     except Exception as e:
-        logger.error(f"Error handling message for user {user_id} ({user_name}): {str(e)}", exc_info=True)
+        logger.error("Error handling message for user %s (%s): %s", user_id, user_name, e, exc_info=True)
+        if messages and messages[-1] is user_entry:
+            # Unanswered, so drop it; the history must keep alternating for the next slice to start on a user turn
+            messages.pop()
         error_message = f"I apologize, {user_name}, but I've encountered an error while processing your request. Please try again later."
         await send_message_with_retry(context, chat_id, error_message)
 
@@ -316,13 +443,8 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
         user_name = get_user_name(update.effective_user) if update.effective_user else "User"
         await send_message_with_retry(context, update.effective_chat.id, f"{user_name}, {error_message}")
 
+@require_auth
 async def set_history_count(update: Update, context: ContextTypes.DEFAULT_TYPE, count=None):
-    user_id = update.effective_user.id
-    user_name = get_user_name(update.effective_user)
-    if not is_authenticated(user_id):
-        await send_message_with_retry(context, update.effective_chat.id, f"I'm sorry, {user_name}, but I can only assist authenticated users. Please provide the secret code first.")
-        return
-
     if count is not None:
         new_count = count
     elif context.args and context.args[0].isdigit():
@@ -334,14 +456,14 @@ async def set_history_count(update: Update, context: ContextTypes.DEFAULT_TYPE,
     set_history_messages_count(new_count)
     await send_message_with_retry(context, update.effective_chat.id, f"History message count has been set to {new_count}.")
 
+@require_auth
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user_name = get_user_name(update.effective_user)
-    if not is_authenticated(user_id):
-        await send_message_with_retry(context, update.effective_chat.id, f"I'm sorry, {user_name}, but I can only assist authenticated users. Please provide the secret code first.")
-        return
 
-    current_scenario = context.user_data.get('scenario', load_user_scenario(user_id))
+    current_scenario = context.user_data.get('scenario')
+    if current_scenario is None:
+        current_scenario = await asyncio.to_thread(load_user_scenario, user_id)
     history_count = get_history_messages_count()
     message_count = len(context.user_data.get('messages', []))
 
@@ -352,7 +474,7 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"🔢 History Messages Count: {history_count}\n"
         f"💬 Current Conversation Messages: {message_count}\n"
     )
-    await send_message_with_retry(context, update.effective_chat.id, status_message, reply_markup=get_common_actions_keyboard())
+    await send_message_with_retry(context, update.effective_chat.id, status_message, reply_markup=COMMON_ACTIONS_KEYBOARD)
 
 async def setup_commands(application: Application):
     menu = [
@@ -366,10 +488,29 @@ async def setup_commands(application: Application):
     ]
     await application.bot.set_my_commands(menu)
 
+async def post_init(application: Application):
+    await setup_commands(application)
+    start_history_flusher()
 
-def main():
+async def post_shutdown(application: Application):
+    # Write out any history messages still waiting for the flusher
+    await stop_history_flusher()
+    await application.bot_data['anthropic'].close()
 
-    application = Application.builder().token(os.getenv("TELEGRAM_BOT_TOKEN")).build()
+def main():
+    if uvloop is not None:
+        # libuv-based loop; must be installed before the application creates its loop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    webhook_url = os.getenv("WEBHOOK_URL")
+    webhook_secret = os.getenv("WEBHOOK_SECRET")
+    if webhook_url and not webhook_secret:
+        # Without it anyone who finds the endpoint can post updates as a whitelisted user
+        raise ValueError("WEBHOOK_SECRET is not set in the environment variables. Please check your .env file.")
+    # A user waiting on their Claude rate limit must not hold up everyone else's updates
+    application = Application.builder().token(os.getenv("TELEGRAM_BOT_TOKEN")).concurrent_updates(True).build()
+    # One Anthropic client for the whole application so calls reuse its connections
+    application.bot_data['anthropic'] = create_client()
     application.add_handler(CommandHandler("set_history_count", set_history_count))
     application.add_handler(CommandHandler("set_history_count_0", lambda update, context: set_history_count(update, context, count=0)))
     application.add_handler(CommandHandler("set_history_count_1", lambda update, context: set_history_count(update, context, count=1)))
@@ -383,8 +524,25 @@ def main():
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_handler(CallbackQueryHandler(button))
     application.add_error_handler(error_handler)
-    application.post_init = setup_commands
-    application.run_polling(poll_interval=1.0, timeout=30)
+    application.post_init = post_init
+    application.post_shutdown = post_shutdown
+    log_listener.start()
+    try:
+        init_history_storage()
+        if webhook_url:
+            # Telegram pushes updates as they arrive, nothing runs while the bot is idle
+            application.run_webhook(
+                listen="0.0.0.0",
+                port=int(os.getenv("PORT", "8443")),
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{webhook_url.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=webhook_secret,
+            )
+        else:
+            # Long polling returns as soon as an update arrives, so keep the pause between polls short
+            application.run_polling(poll_interval=0.1, timeout=30)
+    finally:
+        log_listener.stop()
 
 if __name__ == '__main__':
     main()
@@ -1,5 +1,18 @@
 import re
 
+# Characters reserved by Telegram's MarkdownV2, all of which must be escaped in plain text
+_MD_SPECIAL_CHARS = frozenset('\\_*[]()~`>#+-=|{}.!')
+_MD_ESCAPE_TABLE = str.maketrans({c: '\\' + c for c in _MD_SPECIAL_CHARS})
+
+# Markdown conversions, compiled once at import
+_CODE_BLOCK_RE = re.compile(r'```(\w+)?\n(.*?)\n```', flags=re.DOTALL)
+_BOLD_RE = re.compile(r'\*\*(.*?)\*\*')
+_ITALIC_RE = re.compile(r'__(.*?)__')
+_STRIKETHROUGH_RE = re.compile(r'~~(.*?)~~')
+_UNDERLINE_RE = re.compile(r'___(.+?)___')
+_SPOILER_RE = re.compile(r'\|\|(.*?)\|\|')
+_MD_ESCAPED_RE = re.compile(r'\\([\\_*\[\]()~`>#+\-=|{}.!])')
+
 
 def format_message(message: str) -> str:
     if not isinstance(message, str):
@@ -7,42 +20,67 @@ def format_message(message: str) -> str:
         message = str(message)
 
     # Replace '```' code blocks with '`' for inline code in Telegram
-    message = re.sub(r'```(\w+)?\n(.*?)\n```',
-                     r'`\2`', message, flags=re.DOTALL)
+    message = _CODE_BLOCK_RE.sub(r'`\2`', message)
 
     # Replace '**' with '*' for bold text in Telegram
-    message = re.sub(r'\*\*(.*?)\*\*', r'*\1*', message)
+    message = _BOLD_RE.sub(r'*\1*', message)
 
     # Replace '__' with '_' for italic text in Telegram
-    message = re.sub(r'__(.*?)__', r'_\1_', message)
+    message = _ITALIC_RE.sub(r'_\1_', message)
 
     # Handle strikethrough text (~~text~~)
-    message = re.sub(r'~~(.*?)~~', r'~\1~', message)
+    message = _STRIKETHROUGH_RE.sub(r'~\1~', message)
 
     # Handle underline text (__text__)
-    message = re.sub(r'___(.+?)___', r'__\1__', message)
+    message = _UNDERLINE_RE.sub(r'__\1__', message)
 
     # Handle spoiler text (||text||)
-    message = re.sub(r'\|\|(.*?)\|\|', r'|||\1|||', message)
+    message = _SPOILER_RE.sub(r'|||\1|||', message)
 
-    # Handle inline URLs ([text](URL))
-    message = re.sub(r'\[([^\]]+)\]\(([^\)]+)\)', r'[\1](\2)', message)
+    # Inline URLs ([text](URL)), user mentions (@username), hashtags (#hashtag)
+    # and emoji need no conversion, Telegram uses the same syntax
 
-    # Handle user mentions (@username)
-    message = re.sub(r'@(\w+)', r'@\1', message)
+    # Escape special characters that are not part of Markdown syntax
+    return escape_markdown(message)
 
-    # Handle hashtags (#hashtag)
-    message = re.sub(r'#(\w+)', r'#\1', message)
 
-    # Handle emoji (no change needed, Telegram supports emoji natively)
+def has_markdown_chars(text: str) -> bool:
+    """
+    Check whether the text contains any MarkdownV2 reserved character.
 
-    # Escape special characters that are not part of Markdown syntax
-    special_chars = ['\\', '`', '*', '_',
-                     '{', '}', '[', ']', '(', ')', '#', '+', '-', '.', '!']
-    for char in special_chars:
-        message = message.replace(char, '\\' + char)
+    Args:
+    text (str): The text to check.
+
+    Returns:
+    bool: True if the text needs formatting and escaping before being sent as MarkdownV2.
+    """
+    return not _MD_SPECIAL_CHARS.isdisjoint(text)
+
+
+def escape_markdown(text: str) -> str:
+    """
+    Escape Markdown special characters in a single pass.
 
-    return message
+    Args:
+    text (str): The text to escape.
+
+    Returns:
+    str: The escaped text.
+    """
+    return text.translate(_MD_ESCAPE_TABLE)
+
+
+def unescape_markdown(text: str) -> str:
+    """
+    Remove the escaping added by escape_markdown.
+
+    Args:
+    text (str): The escaped text.
+
+    Returns:
+    str: The text with escaped characters restored.
+    """
+    return _MD_ESCAPED_RE.sub(r'\1', text)
 
 
 def truncate_message(message: str, max_length: int = 4096) -> str: